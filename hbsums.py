@@ -1,105 +1,139 @@
 import argparse
+import errno
 import hashlib
-import json
 import os
-import re
-from functools import partial
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import List
-from urllib.parse import urlparse
 
-ILLEGAL_NAMES = ['CON',
-                 'PRN',
-                 'AUX',
-                 'NUL',
-                 'COM1', 'COM2', 'COM3', 'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9',
-                 'LPT1', 'LPT2', 'LPT3', 'LPT4', 'LPT5', 'LPT6', 'LPT7', 'LPT8', 'LPT9']
+# orjson parses much faster than the standard library, but is optional.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+ILLEGAL_NAMES = frozenset(['CON',
+                           'PRN',
+                           'AUX',
+                           'NUL',
+                           'COM1', 'COM2', 'COM3', 'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9',
+                           'LPT1', 'LPT2', 'LPT3', 'LPT4', 'LPT5', 'LPT6', 'LPT7', 'LPT8', 'LPT9'])
+
+# Translation table deleting reserved characters and control characters, for use by make_safe.
+UNSAFE_CHARS = dict.fromkeys(range(0x20))
+UNSAFE_CHARS.update(dict.fromkeys(map(ord, '\\/*?:"<>|')))
 
 
 # Makes a path component safe for use on Windows (and probably all other systems).
+# Cached, since a product's human name recurs once for each of its downloads.
+@lru_cache(maxsize=4096)
 def make_safe(path_component):
     # See https://msdn.microsoft.com/en-us/library/aa365247.aspx for bad names.
     # Illegal characters are removed, illegal names are deterministically renamed.
 
-    safe_pc = path_component
     # Remove reserved characters.
-    safe_pc = re.sub(r'[\\/*?:"<>|]', '', safe_pc)
-    safe_pc = re.sub('[\u0000-\u001F]', '', safe_pc)
+    safe_pc = path_component.translate(UNSAFE_CHARS)
 
     # Remove trailing '.' or ' '.
-    while safe_pc[-1] == '.' or safe_pc[-1] == ' ':
-        safe_pc = safe_pc[:-1]
+    safe_pc = safe_pc.rstrip('. ')
 
     # Rename if name not legal.
-    if safe_pc.upper().split('.')[0] in ILLEGAL_NAMES:
+    if safe_pc.partition('.')[0].upper() in ILLEGAL_NAMES:
         safe_pc = '_' + safe_pc
 
+    # Rename if nothing is left, e.g. for names made only of dots and spaces.
+    if safe_pc == '':
+        safe_pc = '_'
+
     return safe_pc
 
 
+# Gets the filename from a download URL: the last path segment, without query or fragment.
+def filename_from_url(url):
+    return url.partition('?')[0].partition('#')[0].rpartition('/')[2]
+
+
 class ProductInfo:
-    def __init__(self, human_name, filename, checksum):
+    __slots__ = ('human_name', 'filename', 'checksum', 'safe_human_name', 'safe_filename')
+
+    def __init__(self, human_name, filename, checksum, safe_human_name=None):
         self.human_name = human_name
         self.filename = filename
         self.checksum = checksum
 
-        self.safe_human_name = make_safe(human_name)
+        # The safe human name may be passed in, since it is shared by all of a product's downloads.
+        self.safe_human_name = make_safe(human_name) if safe_human_name is None else safe_human_name
         self.safe_filename = make_safe(filename)
 
 
 def get_product_info(data):
     product_info = []
     for product in data['subproducts']:
+        human_name = product['human_name']
+        safe_human_name = make_safe(human_name)
         for download in product['downloads']:
             for ds in download['download_struct']:
-                human_name = product['human_name']
-                filename = urlparse(ds['url']['web']).path.split("/")[-1]
+                filename = filename_from_url(ds['url']['web'])
                 checksum = ds['md5']
                 info = ProductInfo(human_name,
                                    filename,
-                                   checksum)
+                                   checksum,
+                                   safe_human_name)
                 product_info.append(info)
     return product_info
 
 
 def flat_sums(products: List[ProductInfo]):
-    checksums = []
-    for product in products:
-        checksums.append(product.checksum + ' *./' + product.safe_filename)
-    return checksums
+    return (f'{product.checksum} *./{product.safe_filename}' for product in products)
 
 
 def folder_sums(products: List[ProductInfo]):
-    checksums = []
-    for product in products:
-        checksums.append(product.checksum + ' *./'
-                         + product.safe_human_name + '/'
-                         + product.safe_filename)
-    return checksums
+    return (f'{product.checksum} *./{product.safe_human_name}/{product.safe_filename}' for product in products)
 
 
 def print_checksums(checksums):
+    # Write in bounded chunks, so a lazily generated list of checksums is never fully built.
+    buffer = []
     for checksum in checksums:
-        print(checksum)
+        buffer.append(checksum)
+        if len(buffer) >= 1024:
+            sys.stdout.write('\n'.join(buffer) + '\n')
+            buffer.clear()
+    if buffer:
+        sys.stdout.write('\n'.join(buffer) + '\n')
 
 
 def write_checksums(checksums, filename):
-    fp = open(filename, 'w', newline='\n', encoding='utf-8')
-    for checksum in checksums:
-        fp.write(checksum + '\n')
-    fp.close()
+    with open(filename, 'w', newline='\n', encoding='utf-8') as fp:
+        fp.writelines(f'{checksum}\n' for checksum in checksums)
 
 
 def make_folders(products: List[ProductInfo]):
-    folders = set()
-    for product in products:
-        folders.add(product.safe_human_name)
-    for folder in folders:
-        os.mkdir(folder)
+    for folder in {product.safe_human_name for product in products}:
+        os.makedirs(folder, exist_ok=True)
 
 
 def move_items(products: List[ProductInfo]):
+    failed = 0
     for product in products:
-        os.rename(product.safe_filename, product.safe_human_name + "/" + product.safe_filename)
+        destination = os.path.join(product.safe_human_name, product.safe_filename)
+        try:
+            try:
+                os.replace(product.safe_filename, destination)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Renames cannot cross filesystems, so copy instead.
+                shutil.move(product.safe_filename, destination)
+        except OSError as e:
+            print("Problem on file '" + product.safe_filename + "'")
+            print(e)
+            failed += 1
+
+    if failed:
+        print("Failed to move: ", failed)
 
 
 def make_move(products: List[ProductInfo]):
@@ -107,50 +141,75 @@ def make_move(products: List[ProductInfo]):
     move_items(products)
 
 
+# MD5 is only used to verify downloads against Humble Bundle's published checksums, not for security.
+# Saying so keeps checksum verification working on FIPS-restricted OpenSSL builds, which otherwise refuse MD5.
+new_md5 = partial(hashlib.new, 'md5', usedforsecurity=False)
+
+
+# Hashes a binary file, reading into a large reusable buffer instead of small chunks.
+# hashlib.file_digest does this natively, but is only available from Python 3.11.
+def md5_digest(fp):
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(fp, new_md5)
+
+    md5sum = new_md5()
+    buf = bytearray(2 ** 18)
+    view = memoryview(buf)
+    while True:
+        size = fp.readinto(buf)
+        if not size:
+            break
+        md5sum.update(view[:size])
+    return md5sum
+
+
 class ChecksumItem:
-    def __init__(self, filename, binary_mode):
+    __slots__ = ('filename', '_checksum')
+
+    def __init__(self, filename):
         self.filename = filename
-        self.binary_mode = binary_mode
         self._checksum = ""
 
     def checksum(self):
         if self._checksum == "":
-            mode = 'rb' if self.binary_mode else 'r'
-            # StackOverflow implementation.
-            # See:
-            # http://stackoverflow.com/posts/7829658/revisions
-            with open(self.filename, mode) as fp:
-                md5sum = hashlib.md5()
-                for buf in iter(partial(fp.read, 4096), b''):
-                    md5sum.update(buf)
-            self._checksum = md5sum.hexdigest()
+            # MD5 is defined over bytes, so the file is always read in binary mode.
+            with open(self.filename, 'rb') as fp:
+                self._checksum = md5_digest(fp).hexdigest()
         return self._checksum
 
 
+# Computes an item's checksum, returning the error instead of raising it so it can be reported in order.
+def compute_checksum(item):
+    try:
+        return item['item'].checksum(), None
+    except OSError as e:
+        return None, e
+
+
 def check(checksums):
     items = []
     for line in checksums:
-        binary = False  # default is text mode.
         checksum, filename = line.split(' ', 1)
-        if filename[0] == '*':
-            binary = True  # use binary mode instead.
+        # Drop the mode flag ('*' for binary, ' ' for text); files are always hashed in binary mode.
         filename = filename[1:]
-        items.append({'item': ChecksumItem(filename, binary), 'checksum': checksum})
+        items.append({'item': ChecksumItem(filename), 'checksum': checksum})
 
     failed = 0
     succeeded = 0
-    for item in items:
-        try:
-            if item['item'].checksum() == item['checksum']:
+    # Hash the files in parallel; hashlib releases the GIL while hashing.
+    # Results come back in the original order, so each one is reported as soon as it and those before it are done.
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for item, (digest, error) in zip(items, executor.map(compute_checksum, items)):
+            if error is not None:
+                print("Problem on file '" + item['item'].filename + "'")
+                print(error)
+                failed += 1
+            elif digest == item['checksum']:
                 print(item['item'].filename + ": OK")
                 succeeded += 1
             else:
                 print(item['item'].filename + ": FAILED")
                 failed += 1
-        except PermissionError as e:
-            print("Problem on file '" + item['item'].filename + "'")
-            print(e)
-            failed += 1
 
     print("Succeeded: ", succeeded)
     print("Failed: ", failed)
@@ -247,9 +306,8 @@ def main():
     work_done = False
 
     # Load JSON from file and get the products portion.
-    fp = open(args.filename)
-    data = json.load(fp)
-    fp.close()
+    with open(args.filename, 'rb') as fp:
+        data = json_loads(fp.read())
     products = get_product_info(data)
 
     # First, do directory and file operations.
@@ -268,19 +326,20 @@ def main():
         work_done = True
 
     # Get the checksums in the desired format.
-    checksums = folder_sums(products) if args.folders else flat_sums(products)
+    # The checksums are generated lazily, so each consumer below gets a fresh generator.
+    sums = folder_sums if args.folders else flat_sums
 
     # Print checksums to desired output, if any.
     if args.write:
-        write_checksums(checksums, args.write)
+        write_checksums(sums(products), args.write)
         work_done = True
     if args.print:
-        print_checksums(checksums)
+        print_checksums(sums(products))
         work_done = True
 
     # Check files against checksums.
     if args.check:
-        check(checksums)
+        check(sums(products))
         work_done = True
 
     if not work_done: